@@ -21,12 +21,12 @@ from coconut.root import *  # NOQA
 
 import sys
 import os
+import stat
 import traceback
 import subprocess
 import shutil
 from select import select
 from contextlib import contextmanager
-from copy import copy
 from functools import partial
 
 from coconut.terminal import (
@@ -56,6 +56,7 @@ from coconut.constants import (
     num_added_tb_layers,
     minimum_recursion_limit,
     oserror_retcode,
+    kill_children_timeout,
     base_stub_dir,
     installed_stub_dir,
     WINDOWS,
@@ -77,30 +78,44 @@ if PY34:
 else:
     from imp import reload
 
-try:
-    import prompt_toolkit
-    try:
-        # prompt_toolkit v2
-        from prompt_toolkit.lexers.pygments import PygmentsLexer
-        from prompt_toolkit.styles.pygments import style_from_pygments_cls
-    except ImportError:
-        # prompt_toolkit v1
-        from prompt_toolkit.layout.lexers import PygmentsLexer
-        from prompt_toolkit.styles import style_from_pygments as style_from_pygments_cls
+_reserved_vars_dict = dict.fromkeys(reserved_vars)
 
-    import pygments
-    import pygments.styles
+# prompt_toolkit and pygments are expensive to import, so they're only
+#  imported by _ensure_prompt_toolkit once the prompt is actually needed
+prompt_toolkit = None
+_prompt_toolkit_imported = False
 
-    from coconut.highlighter import CoconutLexer
-except ImportError:
-    prompt_toolkit = None
-except KeyError:
-    complain(
-        ImportError(
-            "detected outdated pygments version (run 'pip install --upgrade pygments' to fix)",
-        ),
-    )
-    prompt_toolkit = None
+
+def _ensure_prompt_toolkit():
+    """Import prompt_toolkit if it hasn't been imported yet, returning it or None if unavailable."""
+    global prompt_toolkit, _prompt_toolkit_imported, PygmentsLexer, style_from_pygments_cls, pygments, CoconutLexer
+    if not _prompt_toolkit_imported:
+        _prompt_toolkit_imported = True
+        try:
+            import prompt_toolkit
+            try:
+                # prompt_toolkit v2
+                from prompt_toolkit.lexers.pygments import PygmentsLexer
+                from prompt_toolkit.styles.pygments import style_from_pygments_cls
+            except ImportError:
+                # prompt_toolkit v1
+                from prompt_toolkit.layout.lexers import PygmentsLexer
+                from prompt_toolkit.styles import style_from_pygments as style_from_pygments_cls
+
+            import pygments
+            import pygments.styles
+
+            from coconut.highlighter import CoconutLexer
+        except ImportError:
+            prompt_toolkit = None
+        except KeyError:
+            complain(
+                ImportError(
+                    "detected outdated pygments version (run 'pip install --upgrade pygments' to fix)",
+                ),
+            )
+            prompt_toolkit = None
+    return prompt_toolkit
 
 # -----------------------------------------------------------------------------------------------------------------------
 # FUNCTIONS:
@@ -110,8 +125,8 @@ except KeyError:
 def writefile(openedfile, newcontents):
     """Set the contents of a file."""
     openedfile.seek(0)
-    openedfile.truncate()
     openedfile.write(newcontents)
+    openedfile.truncate()  # truncating after writing is faster than before
 
 
 def readfile(openedfile):
@@ -137,10 +152,13 @@ def showpath(path):
     if logger.verbose:
         return os.path.abspath(path)
     else:
-        path = os.path.relpath(path)
-        if path.startswith(os.curdir + os.sep):
-            path = path[len(os.curdir + os.sep):]
-        return path
+        cwd = os.getcwd()
+        path = os.path.normpath(os.path.join(cwd, path))
+        # fast path for the common case of paths inside the current directory
+        cwd_prefix = os.path.join(cwd, "")
+        if path.startswith(cwd_prefix) and len(path) > len(cwd_prefix):
+            return path[len(cwd_prefix):]
+        return os.path.relpath(path, cwd)
 
 
 def is_special_dir(dirname):
@@ -150,12 +168,13 @@ def is_special_dir(dirname):
 
 def rem_encoding(code):
     """Remove encoding declarations from compiled code so it can be passed to exec."""
-    old_lines = code.splitlines()
-    new_lines = []
-    for i in range(min(2, len(old_lines))):
-        line = old_lines[i]
-        if not (line.lstrip().startswith("#") and "coding" in line):
-            new_lines.append(line)
+    # encoding declarations can only be on the first two lines, so don't split the rest;
+    #  unlike splitlines, this leaves line endings untouched, which exec accepts as-is
+    old_lines = code.split("\n", 2)
+    new_lines = [
+        line for line in old_lines[:2]
+        if not (line.lstrip().startswith("#") and "coding" in line)
+    ]
     new_lines += old_lines[2:]
     return "\n".join(new_lines)
 
@@ -206,13 +225,17 @@ def kill_children():
     else:
         parent = psutil.Process()
         children = parent.children(recursive=True)
-        while children:
-            for child in children:
-                try:
-                    child.terminate()
-                except psutil.NoSuchProcess:
-                    pass  # process is already dead, so do nothing
-            children = parent.children(recursive=True)
+        for child in children:
+            try:
+                child.terminate()
+            except psutil.NoSuchProcess:
+                pass  # process is already dead, so do nothing
+        _, alive = psutil.wait_procs(children, timeout=kill_children_timeout)
+        for child in alive:
+            try:
+                child.kill()
+            except psutil.NoSuchProcess:
+                pass
 
 
 def splitname(path):
@@ -220,43 +243,59 @@ def splitname(path):
     dirpath, filename = os.path.split(path)
     # we don't use os.path.splitext here because we want all extensions,
     #  not just the last, to be put in exts
-    name, exts = filename.split(os.extsep, 1)
+    name, _, exts = filename.partition(os.extsep)
     return dirpath, name, exts
 
 
-def run_file(path):
-    """Run a module from a path and return its variables."""
-    if PY26:
+if PY26:
+    def run_file(path):
+        """Run a module from a path and return its variables."""
         dirpath, name, _ = splitname(path)
         found = imp.find_module(name, [dirpath])
         module = imp.load_module("__main__", *found)
         return vars(module)
-    else:
+else:
+    def run_file(path):
+        """Run a module from a path and return its variables."""
         return runpy.run_path(path, run_name="__main__")
 
 
 def call_output(cmd, stdin=None, encoding_errors="replace", **kwargs):
     """Run command and read output."""
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
-    stdout, stderr, retcode = [], [], None
-    while retcode is None:
-        if stdin is not None:
-            logger.log_prefix("<0 ", stdin.rstrip())
-        raw_out, raw_err = p.communicate(stdin)
-        stdin = None
+    if stdin is not None:
+        logger.log_prefix("<0 ", stdin.rstrip())
+    raw_out, raw_err = p.communicate(stdin)  # reads until EOF, so only needs to be called once
+    retcode = p.wait()
 
-        out = raw_out.decode(get_encoding(sys.stdout), encoding_errors) if raw_out else ""
-        if out:
-            logger.log_prefix("1> ", out.rstrip())
-        stdout.append(out)
+    out = raw_out.decode(get_encoding(sys.stdout), encoding_errors) if raw_out else ""
+    if out:
+        logger.log_prefix("1> ", out.rstrip())
 
-        err = raw_err.decode(get_encoding(sys.stderr), encoding_errors) if raw_err else ""
-        if err:
-            logger.log_prefix("2> ", err.rstrip())
-        stderr.append(err)
+    err = raw_err.decode(get_encoding(sys.stderr), encoding_errors) if raw_err else ""
+    if err:
+        logger.log_prefix("2> ", err.rstrip())
 
-        retcode = p.poll()
-    return stdout, stderr, retcode
+    return [out], [err], retcode
+
+
+_which_cache = {}
+
+
+def which(exe):
+    """Resolve an executable name to its full path, caching successful lookups."""
+    if not hasattr(shutil, "which"):
+        return exe
+    # names with a path separator are resolved relative to the cwd, so they can't be cached
+    if os.sep in exe or (os.altsep is not None and os.altsep in exe):
+        return shutil.which(exe) or exe
+    resolved = _which_cache.get(exe)
+    if resolved is None:
+        resolved = shutil.which(exe)
+        if resolved is None:
+            return exe  # don't cache failures, since exe might be added to PATH later
+        _which_cache[exe] = resolved
+    return resolved
 
 
 def run_cmd(cmd, show_output=True, raise_errs=True, **kwargs):
@@ -266,8 +305,7 @@ def run_cmd(cmd, show_output=True, raise_errs=True, **kwargs):
     When raise_errs=True, raises a subprocess.CalledProcessError if the command fails.
     """
     internal_assert(cmd and isinstance(cmd, list), "console commands must be passed as non-empty lists")
-    if hasattr(shutil, "which"):
-        cmd[0] = shutil.which(cmd[0]) or cmd[0]
+    cmd[0] = which(cmd[0])
     logger.log_cmd(cmd)
     try:
         if show_output and raise_errs:
@@ -275,8 +313,9 @@ def run_cmd(cmd, show_output=True, raise_errs=True, **kwargs):
         elif show_output:
             return subprocess.call(cmd, **kwargs)
         else:
-            stdout, stderr, retcode = call_output(cmd, **kwargs)
-            output = "".join(stdout + stderr)
+            # call_output reads everything at once, so stdout and stderr are single-element lists
+            (stdout,), (stderr,), retcode = call_output(cmd, **kwargs)
+            output = stdout + stderr
             if retcode and raise_errs:
                 raise subprocess.CalledProcessError(retcode, cmd, output=output)
             return output
@@ -290,19 +329,33 @@ def run_cmd(cmd, show_output=True, raise_errs=True, **kwargs):
             return ""
 
 
+if PY32:
+    _symlink_dir = partial(os.symlink, target_is_directory=True)
+elif not WINDOWS:
+    _symlink_dir = os.symlink
+else:
+    _symlink_dir = None
+
+
 def symlink(link_to, link_from):
     """Link link_from to the directory link_to universally."""
-    if os.path.exists(link_from) and not os.path.islink(link_from):
+    # lstat once up front rather than separately checking exists and islink
+    try:
+        st = os.lstat(link_from)
+    except OSError:
+        exists = is_link = False
+    else:
+        exists, is_link = True, stat.S_ISLNK(st.st_mode)
+    if exists and not is_link:
         shutil.rmtree(link_from)
     try:
-        if PY32:
-            os.symlink(link_to, link_from, target_is_directory=True)
-        elif not WINDOWS:
-            os.symlink(link_to, link_from)
+        if _symlink_dir is not None:
+            _symlink_dir(link_to, link_from)
     except OSError:
         logger.log_exc()
     else:
         return
+    # re-check here, since something else may have created the link in the meantime
     if not os.path.islink(link_from):
         shutil.copytree(link_to, link_from)
 
@@ -324,16 +377,19 @@ def set_mypy_path():
 
 def stdin_readable():
     """Determine whether stdin has any data to read."""
+    # check isatty first, since a terminal is never piped input and select is a syscall
+    try:
+        if sys.stdin.isatty():
+            return False
+    except Exception:
+        logger.log_exc()
+        return False
     if not WINDOWS:
         try:
             return bool(select([sys.stdin], [], [], 0)[0])
         except Exception:
             logger.log_exc()
-    try:
-        return not sys.stdin.isatty()
-    except Exception:
-        logger.log_exc()
-    return False
+    return True
 
 
 def set_recursion_limit(limit):
@@ -368,6 +424,12 @@ def canparse(argparser, args):
 class Prompt(object):
     """Manages prompting for code on the command line."""
     style = None
+    history = None
+    _prompt = None
+    _lexer = None
+    _style_obj = None
+    _default_style = None
+    _default_history_file = None
     multiline = prompt_multiline
     vi_mode = prompt_vi_mode
     wrap_lines = prompt_wrap_lines
@@ -375,33 +437,54 @@ class Prompt(object):
 
     def __init__(self):
         """Set up the prompt."""
-        if prompt_toolkit is not None:
-            self.set_style(os.environ.get(style_env_var, default_style))
-            self.set_history_file(default_histfile)
+        # the defaults are only applied on first use, since they require importing prompt_toolkit
+        self._default_style = os.environ.get(style_env_var, default_style)
+        self._default_history_file = default_histfile
+
+    def set_defaults(self):
+        """Apply the default style and history file if they haven't been set explicitly."""
+        style, history_file = self._default_style, self._default_history_file
+        self._default_style = self._default_history_file = None
+        if (style is not None or history_file is not None) and _ensure_prompt_toolkit() is not None:
+            if style is not None:
+                self.set_style(style)
+            if history_file is not None:
+                self.set_history_file(history_file)
 
     def set_style(self, style):
         """Set pygments syntax highlighting style."""
+        self._default_style = None
         if style == "none":
             self.style = None
-        elif prompt_toolkit is None:
+        elif _ensure_prompt_toolkit() is None:
             raise CoconutException("syntax highlighting is not supported on this Python version")
         elif style == "list":
             print("Coconut Styles: none, " + ", ".join(pygments.styles.get_all_styles()))
             sys.exit(0)
         elif style in pygments.styles.get_all_styles():
             self.style = style
+            if self._lexer is None:
+                # the lexer doesn't depend on the style, so only build it once
+                self._lexer = PygmentsLexer(CoconutLexer)
+            self._style_obj = style_from_pygments_cls(
+                pygments.styles.get_style_by_name(style),
+            )
         else:
             raise CoconutException("unrecognized pygments style", style, extra="use '--style list' to show all valid styles")
 
     def set_history_file(self, path):
         """Set path to history file. Pass empty string for in-memory history."""
+        self._default_history_file = None
+        _ensure_prompt_toolkit()
         if path:
             self.history = prompt_toolkit.history.FileHistory(fixpath(path))
         else:
             self.history = prompt_toolkit.history.InMemoryHistory()
+        self._prompt = None  # rebuilt lazily on the next prompt
 
     def input(self, more=False):
         """Prompt for code input."""
+        self.set_defaults()
         sys.stdout.flush()
         if more:
             msg = more_prompt
@@ -421,25 +504,52 @@ class Prompt(object):
 
     def prompt(self, msg):
         """Get input using prompt_toolkit."""
-        try:
-            # prompt_toolkit v2
-            prompt = prompt_toolkit.PromptSession(history=self.history).prompt
-        except AttributeError:
-            # prompt_toolkit v1
-            prompt = partial(prompt_toolkit.prompt, history=self.history)
-        return prompt(
+        if self._prompt is None:
+            try:
+                # prompt_toolkit v2
+                self._prompt = prompt_toolkit.PromptSession(history=self.history).prompt
+            except AttributeError:
+                # prompt_toolkit v1
+                self._prompt = partial(prompt_toolkit.prompt, history=self.history)
+        return self._prompt(
             msg,
             multiline=self.multiline,
             vi_mode=self.vi_mode,
             wrap_lines=self.wrap_lines,
             enable_history_search=self.history_search,
-            lexer=PygmentsLexer(CoconutLexer),
-            style=style_from_pygments_cls(
-                pygments.styles.get_style_by_name(self.style),
-            ),
+            lexer=self._lexer,
+            style=self._style_obj,
         )
 
 
+class _ErrorHandler(object):
+    """Context manager for handling Runner execution errors."""
+
+    def __init__(self, runner, all_errors_exit):
+        """Create the error handler."""
+        self.runner = runner
+        self.all_errors_exit = all_errors_exit
+
+    def __enter__(self):
+        """Start handling errors."""
+
+    def __exit__(self, etype, value, tb):
+        """Handle any error that occurred."""
+        if etype is None:
+            return False
+        if issubclass(etype, SystemExit):
+            self.runner.exit(value.code)
+        else:
+            for _ in range(num_added_tb_layers):
+                if tb is None:
+                    break
+                tb = tb.tb_next
+            traceback.print_exception(etype, value, tb)
+            if self.all_errors_exit:
+                self.runner.exit(1)
+        return True
+
+
 class Runner(object):
     """Compiled Python executor."""
 
@@ -449,6 +559,7 @@ class Runner(object):
         auto_compilation(on=True)
         use_coconut_breakpoint(on=False)
         self.exit = exit
+        self._error_handlers = (_ErrorHandler(self, False), _ErrorHandler(self, True))
         self.vars = self.build_vars(path)
         self.stored = [] if store else None
         if comp is not None:
@@ -467,8 +578,7 @@ class Runner(object):
         if path is not None:
             init_vars["__file__"] = fixpath(path)
         # put reserved_vars in for auto-completion purposes
-        for var in reserved_vars:
-            init_vars[var] = None
+        init_vars.update(_reserved_vars_dict)
         return init_vars
 
     def store(self, line):
@@ -479,36 +589,22 @@ class Runner(object):
     def fix_pickle(self):
         """Fix pickling of Coconut header objects."""
         from coconut import __coconut__  # this is expensive, so only do it here
+        coconut_vars = set(dir(__coconut__))
         for var in self.vars:
-            if not var.startswith("__") and var in dir(__coconut__):
+            if not var.startswith("__") and var in coconut_vars:
                 self.vars[var] = getattr(__coconut__, var)
 
-    @contextmanager
     def handling_errors(self, all_errors_exit=False):
         """Handle execution errors."""
-        try:
-            yield
-        except SystemExit as err:
-            self.exit(err.code)
-        except BaseException:
-            etype, value, tb = sys.exc_info()
-            for _ in range(num_added_tb_layers):
-                if tb is None:
-                    break
-                tb = tb.tb_next
-            traceback.print_exception(etype, value, tb)
-            if all_errors_exit:
-                self.exit(1)
+        return self._error_handlers[bool(all_errors_exit)]
 
     def update_vars(self, global_vars, ignore_vars=None):
         """Add Coconut built-ins to given vars."""
         if ignore_vars:
-            update_vars = self.vars.copy()
-            for del_var in ignore_vars:
-                del update_vars[del_var]
+            ignore_vars = set(ignore_vars)
+            global_vars.update((k, v) for k, v in self.vars.items() if k not in ignore_vars)
         else:
-            update_vars = self.vars
-        global_vars.update(update_vars)
+            global_vars.update(self.vars)
 
     def run(self, code, use_eval=None, path=None, all_errors_exit=False, store=True):
         """Execute Python code."""
@@ -555,11 +651,11 @@ class multiprocess_wrapper(object):
     def __init__(self, base, method):
         """Create new multiprocessable method."""
         self.recursion = sys.getrecursionlimit()
-        self.logger = copy(logger)
+        self.logger_state = logger.snapshot()
         self.base, self.method = base, method
 
     def __call__(self, *args, **kwargs):
         """Call the method."""
         sys.setrecursionlimit(self.recursion)
-        logger.copy_from(self.logger)
+        logger.restore(self.logger_state)
         return getattr(self.base, self.method)(*args, **kwargs)
@@ -645,7 +645,7 @@ coconut_run_args = ("--run", "--target", "sys", "--quiet")
 coconut_run_verbose_args = ("--run", "--target", "sys")
 coconut_import_hook_args = ("--target", "sys", "--quiet")
 
-num_added_tb_layers = 3  # how many frames to remove when printing a tb
+num_added_tb_layers = 2  # how many frames to remove when printing a tb
 
 verbose_mypy_args = (
     "--warn-incomplete-stub",
@@ -661,6 +661,8 @@ mypy_non_err_prefixes = (
 
 oserror_retcode = 127
 
+kill_children_timeout = 3  # seconds
+
 # -----------------------------------------------------------------------------------------------------------------------
 # HIGHLIGHTER CONSTANTS:
 # -----------------------------------------------------------------------------------------------------------------------
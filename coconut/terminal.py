@@ -119,7 +119,15 @@ class Logger(object):
 
     def copy_from(self, other):
         """Copy other onto self."""
-        self.verbose, self.quiet, self.path, self.name, self.tracing, self.trace_ind = other.verbose, other.quiet, other.path, other.name, other.tracing, other.trace_ind
+        self.restore(other.snapshot())
+
+    def snapshot(self):
+        """Get a picklable tuple of the logger's state."""
+        return self.verbose, self.quiet, self.path, self.name, self.tracing, self.trace_ind
+
+    def restore(self, state):
+        """Restore the logger's state from a snapshot."""
+        self.verbose, self.quiet, self.path, self.name, self.tracing, self.trace_ind = state
 
     def display(self, messages, sig="", debug=False):
         """Prints an iterator of messages."""